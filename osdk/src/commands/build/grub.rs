@@ -1,8 +1,10 @@
 // SPDX-License-Identifier: MPL-2.0
 
 use std::{
+    fmt::Write,
     fs,
     path::{Path, PathBuf},
+    time::SystemTime,
 };
 
 use super::bin::make_install_bzimage;
@@ -34,19 +36,21 @@ pub fn create_bootdev_image(
     };
     let protocol = &action.grub.boot_protocol;
 
-    // Clear or make the iso dir.
-    if iso_root.exists() {
-        fs::remove_dir_all(iso_root).unwrap();
-    }
+    // Make the iso dir. The staged files from the last build are kept so that
+    // unchanged inputs do not need to be copied again.
     fs::create_dir_all(iso_root.join("boot").join("grub")).unwrap();
 
+    // Remove the files staged by previous builds that do not belong to this
+    // image, e.g., the kernels of other crates sharing the target directory.
+    let mut boot_files = vec!["grub", target_name.as_str()];
+    if initramfs_path.is_some() {
+        boot_files.push("initramfs.cpio.gz");
+    }
+    remove_all_except(iso_root.join("boot"), &boot_files);
+
     // Copy the initramfs to the boot directory.
     if let Some(init_path) = &initramfs_path {
-        fs::copy(
-            init_path.as_ref().to_str().unwrap(),
-            iso_root.join("boot").join("initramfs.cpio.gz"),
-        )
-        .unwrap();
+        copy_if_outdated(init_path, iso_root.join("boot").join("initramfs.cpio.gz"));
     }
 
     // Make the kernel image and place it in the boot directory.
@@ -62,7 +66,7 @@ pub fn create_bootdev_image(
         _ => {
             // Copy the kernel image to the boot directory.
             let target_path = iso_root.join("boot").join(&target_name);
-            fs::copy(aster_bin.path(), target_path).unwrap();
+            copy_if_outdated(aster_bin.path(), target_path);
         }
     };
 
@@ -79,28 +83,135 @@ pub fn create_bootdev_image(
         protocol,
     );
     let grub_cfg_path = iso_root.join("boot").join("grub").join("grub.cfg");
-    fs::write(grub_cfg_path, grub_cfg).unwrap();
+    // Only touch the grub.cfg file if it changes, so that it does not
+    // invalidate the cached image.
+    if fs::read_to_string(&grub_cfg_path).ok().as_ref() != Some(&grub_cfg) {
+        fs::write(grub_cfg_path, grub_cfg).unwrap();
+    }
 
-    // Make the boot device CDROM image using `grub-mkrescue`.
+    // Make the boot device CDROM image using `grub-mkrescue`, unless the
+    // cached image was made from the same inputs. The image returned from here
+    // is moved into the bundle, so the cached image is kept aside. Like the iso
+    // dir, the cache has a single slot shared by all the crates.
     let iso_path = &target_dir.as_ref().join(target_name.to_string() + ".iso");
-    let mut grub_mkrescue_cmd = std::process::Command::new(action.grub.grub_mkrescue.as_os_str());
-    grub_mkrescue_cmd
-        .arg(iso_root.as_os_str())
-        .arg("-o")
-        .arg(iso_path);
-    if !grub_mkrescue_cmd.status().unwrap().success() {
-        panic!("Failed to run {:#?}.", grub_mkrescue_cmd);
+    let cached_iso_path = &target_dir.as_ref().join("cached.iso");
+    let stamp_path = cached_iso_path.with_extension("iso.stamp");
+    let grub_version = get_grub_mkrescue_version(&action.grub.grub_mkrescue);
+    let stamp = generate_iso_stamp(iso_root, &action.grub.grub_mkrescue, &grub_version);
+    let iso_is_up_to_date =
+        cached_iso_path.exists() && fs::read_to_string(&stamp_path).ok().as_ref() == Some(&stamp);
+    if iso_is_up_to_date {
+        info!("Reusing the cached boot device image");
+    } else {
+        // Drop the stale stamp and write to a temporary file first, so that a
+        // failed or interrupted run never leaves a partial image that appears
+        // to be up to date.
+        let _ = fs::remove_file(&stamp_path);
+        let tmp_iso_path = cached_iso_path.with_extension("iso.tmp");
+        let mut grub_mkrescue_cmd =
+            std::process::Command::new(action.grub.grub_mkrescue.as_os_str());
+        grub_mkrescue_cmd
+            .arg(iso_root.as_os_str())
+            .arg("-o")
+            .arg(&tmp_iso_path);
+        if !grub_mkrescue_cmd.status().unwrap().success() {
+            let _ = fs::remove_file(&tmp_iso_path);
+            panic!("Failed to run {:#?}.", grub_mkrescue_cmd);
+        }
+        fs::rename(&tmp_iso_path, cached_iso_path).unwrap();
+        fs::write(&stamp_path, stamp).unwrap();
+    }
+
+    // Place the cached image at `iso_path`, preferably as a hard link.
+    if iso_path.exists() {
+        fs::remove_file(iso_path).unwrap();
+    }
+    if fs::hard_link(cached_iso_path, iso_path).is_err() {
+        fs::copy(cached_iso_path, iso_path).unwrap();
     }
 
     AsterVmImage::new(
         iso_path,
-        AsterVmImageType::GrubIso(AsterGrubIsoImageMeta {
-            grub_version: get_grub_mkrescue_version(&action.grub.grub_mkrescue),
-        }),
+        AsterVmImageType::GrubIso(AsterGrubIsoImageMeta { grub_version }),
         aster_bin.version().clone(),
     )
 }
 
+/// Generates a stamp describing all the inputs of `grub-mkrescue`.
+///
+/// The stamp records the `grub-mkrescue` binary and its version, and the
+/// path, size and modification time of every file in the iso dir.
+fn generate_iso_stamp(iso_root: &Path, grub_mkrescue: &Path, grub_version: &str) -> String {
+    let mut stamp = format!("{}\n{}\n", grub_mkrescue.display(), grub_version.trim());
+    append_iso_root_files(&mut stamp, iso_root, iso_root);
+    stamp
+}
+
+fn append_iso_root_files(stamp: &mut String, iso_root: &Path, dir: &Path) {
+    let mut entries = fs::read_dir(dir)
+        .unwrap()
+        .map(|entry| entry.unwrap())
+        .collect::<Vec<_>>();
+    entries.sort_by_key(|entry| entry.file_name());
+    for entry in entries {
+        let metadata = entry.metadata().unwrap();
+        if metadata.is_dir() {
+            append_iso_root_files(stamp, iso_root, &entry.path());
+            continue;
+        }
+        let modified = metadata
+            .modified()
+            .unwrap()
+            .duration_since(SystemTime::UNIX_EPOCH)
+            .unwrap();
+        writeln!(
+            stamp,
+            "{} {} {}",
+            entry.path().strip_prefix(iso_root).unwrap().display(),
+            metadata.len(),
+            modified.as_nanos()
+        )
+        .unwrap();
+    }
+}
+
+/// Removes all the entries in `dir` except those named in `keep`.
+fn remove_all_except(dir: impl AsRef<Path>, keep: &[&str]) {
+    for entry in fs::read_dir(dir).unwrap() {
+        let entry = entry.unwrap();
+        if keep.iter().any(|name| entry.file_name() == *name) {
+            continue;
+        }
+        if entry.file_type().unwrap().is_dir() {
+            fs::remove_dir_all(entry.path()).unwrap();
+        } else {
+            fs::remove_file(entry.path()).unwrap();
+        }
+    }
+}
+
+/// Copies `src` to `dst` unless `dst` is already an up-to-date copy of `src`.
+///
+/// The copy gets the modification time of its source, and it is considered
+/// up-to-date if both its size and modification time match the source.
+fn copy_if_outdated(src: impl AsRef<Path>, dst: impl AsRef<Path>) {
+    let src_meta = fs::metadata(&src).unwrap();
+    let src_modified = src_meta.modified().unwrap();
+    if let Ok(dst_meta) = fs::metadata(&dst) {
+        if dst_meta.len() == src_meta.len() && dst_meta.modified().unwrap() == src_modified {
+            return;
+        }
+        // The copy inherits the permissions of its source and may be
+        // read-only, so remove it rather than overwrite it.
+        fs::remove_file(&dst).unwrap();
+    }
+    fs::copy(&src, &dst).unwrap();
+    fs::File::open(&dst)
+        .unwrap()
+        .set_modified(src_modified)
+        .unwrap();
+}
+
 fn generate_grub_cfg(
     kcmdline: &str,
     skip_grub_menu: bool,
@@ -170,3 +281,131 @@ fn get_grub_mkrescue_version(grub_mkrescue: &PathBuf) -> String {
     let output = cmd.output().unwrap();
     String::from_utf8(output.stdout).unwrap()
 }
+
+#[cfg(test)]
+mod test {
+    use std::{
+        os::unix::fs::PermissionsExt,
+        time::{Duration, SystemTime},
+    };
+
+    use super::*;
+
+    fn new_test_dir(name: &str) -> PathBuf {
+        let dir = std::env::temp_dir().join(format!("osdk_test_grub_{}", name));
+        let _ = fs::remove_dir_all(&dir);
+        fs::create_dir_all(&dir).unwrap();
+        dir
+    }
+
+    fn modified(path: impl AsRef<Path>) -> SystemTime {
+        fs::metadata(path).unwrap().modified().unwrap()
+    }
+
+    fn set_modified(path: impl AsRef<Path>, time: SystemTime) {
+        fs::File::open(path).unwrap().set_modified(time).unwrap();
+    }
+
+    #[test]
+    fn copy_if_outdated_skips_unchanged_source() {
+        let dir = new_test_dir("skip_unchanged");
+        let (src, dst) = (dir.join("src"), dir.join("dst"));
+        fs::write(&src, "kernel").unwrap();
+        copy_if_outdated(&src, &dst);
+        assert_eq!(modified(&dst), modified(&src));
+
+        // Alter the copy without changing its size or modification time, so
+        // that copying it again would be noticed.
+        fs::write(&dst, "KERNEL").unwrap();
+        set_modified(&dst, modified(&src));
+        copy_if_outdated(&src, &dst);
+        assert_eq!(fs::read_to_string(&dst).unwrap(), "KERNEL");
+
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[test]
+    fn copy_if_outdated_recopies_older_source_of_same_size() {
+        let dir = new_test_dir("recopy_older");
+        let (src, dst) = (dir.join("src"), dir.join("dst"));
+        fs::write(&src, "old").unwrap();
+        copy_if_outdated(&src, &dst);
+
+        fs::write(&src, "new").unwrap();
+        let older = modified(&dst) - Duration::from_secs(3600);
+        set_modified(&src, older);
+        copy_if_outdated(&src, &dst);
+        assert_eq!(fs::read_to_string(&dst).unwrap(), "new");
+        assert_eq!(modified(&dst), older);
+
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[test]
+    fn copy_if_outdated_replaces_read_only_copy() {
+        let dir = new_test_dir("replace_read_only");
+        let (src, dst) = (dir.join("src"), dir.join("dst"));
+        fs::write(&src, "old").unwrap();
+        fs::set_permissions(&src, fs::Permissions::from_mode(0o444)).unwrap();
+        copy_if_outdated(&src, &dst);
+        assert!(fs::metadata(&dst).unwrap().permissions().readonly());
+
+        fs::set_permissions(&src, fs::Permissions::from_mode(0o644)).unwrap();
+        fs::write(&src, "new content").unwrap();
+        copy_if_outdated(&src, &dst);
+        assert_eq!(fs::read_to_string(&dst).unwrap(), "new content");
+
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[test]
+    fn remove_all_except_keeps_named_entries() {
+        let dir = new_test_dir("remove_all_except");
+        fs::create_dir_all(dir.join("grub")).unwrap();
+        fs::write(dir.join("grub").join("grub.cfg"), "").unwrap();
+        fs::write(dir.join("kernel"), "").unwrap();
+        fs::write(dir.join("stale-kernel"), "").unwrap();
+        fs::create_dir_all(dir.join("stale-dir")).unwrap();
+
+        remove_all_except(&dir, &["grub", "kernel"]);
+        let mut names = fs::read_dir(&dir)
+            .unwrap()
+            .map(|entry| entry.unwrap().file_name().into_string().unwrap())
+            .collect::<Vec<_>>();
+        names.sort();
+        assert_eq!(names, ["grub", "kernel"]);
+        assert!(dir.join("grub").join("grub.cfg").exists());
+
+        fs::remove_dir_all(dir).unwrap();
+    }
+
+    #[test]
+    fn iso_stamp_tracks_iso_root_files() {
+        let dir = new_test_dir("iso_stamp");
+        let grub_mkrescue = Path::new("grub-mkrescue");
+        fs::create_dir_all(dir.join("boot").join("grub")).unwrap();
+        fs::write(dir.join("boot").join("grub").join("grub.cfg"), "cfg").unwrap();
+        let stamp = generate_iso_stamp(&dir, grub_mkrescue, "2.06");
+        assert_eq!(stamp, generate_iso_stamp(&dir, grub_mkrescue, "2.06"));
+        assert_ne!(stamp, generate_iso_stamp(&dir, grub_mkrescue, "2.12"));
+
+        // Adding a file.
+        let kernel = dir.join("boot").join("kernel");
+        fs::write(&kernel, "kernel").unwrap();
+        let stamp_with_kernel = generate_iso_stamp(&dir, grub_mkrescue, "2.06");
+        assert_ne!(stamp_with_kernel, stamp);
+
+        // Touching a file.
+        set_modified(&kernel, modified(&kernel) - Duration::from_secs(3600));
+        let stamp_touched = generate_iso_stamp(&dir, grub_mkrescue, "2.06");
+        assert_ne!(stamp_touched, stamp_with_kernel);
+
+        // Removing a file.
+        fs::remove_file(&kernel).unwrap();
+        let stamp_removed = generate_iso_stamp(&dir, grub_mkrescue, "2.06");
+        assert_ne!(stamp_removed, stamp_touched);
+        assert_eq!(stamp_removed, stamp);
+
+        fs::remove_dir_all(dir).unwrap();
+    }
+}
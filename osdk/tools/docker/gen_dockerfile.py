@@ -43,10 +43,14 @@ def load_template(template_dir):
     with open(template_file, 'r') as file:
         return file.read()
 
+TEMPLATE_VAR_PATTERN = re.compile(r'{%\s*(\w+)\s*%}')
+
 def generate_dockerfile_content(variables, template_content):
-    for var_name, var_value in variables.items():
-        template_content = re.sub(r'{%\s*' + var_name + r'\s*%}', var_value, template_content)
-    return template_content
+    # Substitute all the variables in a single pass. Unknown variables are left untouched.
+    return TEMPLATE_VAR_PATTERN.sub(
+        lambda match: variables.get(match.group(1), match.group(0)),
+        template_content
+    )
 
 def write_dockerfile(output_directory, content):
     output_path = os.path.join(output_directory, 'Dockerfile')